@@ -1,4 +1,5 @@
-from typing import Optional, Callable, AsyncIterator, Union, Dict, List
+from typing import Optional, Callable, AsyncIterator, Union, Dict, List, Tuple
+import functools
 import datetime
 import asyncio
 import logging
@@ -7,19 +8,60 @@ import time
 import os
 import re
 
-import aiofiles.os
-import aiofiles
 import httpx
 import bs4
+import lxml.html
 
 from . import session, urls
+from .parsing import (
+    get_class_pattern, decode_page, scan_anchors, has_class)
 
 
+_INVALID_FN_RE = re.compile(r'[^-\s\w.]')
+_ASSIGNMENT_DATA_RE = re.compile(r"'(\d+)','(\d+)','(\d+)'")
+_FOLDER_RE = re.compile(r"'(\d+)','(\d+)','(\d+)'")
+_FILE_RE = re.compile(r"(\d+)$")
+# File type could not be defined
+_INFO_RE = re.compile(r"(\w*) *\[([\w ]+)\]")
+# The `tmpTitle` js variable holds a 7 lines long HTML string
+_TMPTITLE_RE = re.compile(rb"^[^\n]*tmpTitle = [^\n]*(?:\n[^\n]*){0,6}", re.M)
+# The headers head() reads the file infos from
+_FILE_INFO_HEADERS = ("Content-Length", "Last-Modified", "ETag")
+
+# Downloads are read and written in chunks of this size
+_CHUNK_SIZE = 1 << 20
+
+
+_ANCHORS_STRAINER = bs4.SoupStrainer("a")
+_ASSIGNMENTS_STRAINER = bs4.SoupStrainer("a", class_=get_class_pattern("policorpo"))
+_VIDEOLESSONS_STRAINER = bs4.SoupStrainer(["a", "span", "li"])
+
+
+@functools.lru_cache(maxsize=4096)
 def get_valid_filename(filename: str) -> str:
     """
     Replace invalid filename characters with an underscore
     """
-    return re.sub(r'[^-\s\w.]', '_', filename)
+    return _INVALID_FN_RE.sub('_', filename)
+
+
+def _cancel(tasks: List["asyncio.Task"]) -> None:
+    """
+    Cancel the tasks that are still running
+    """
+    for task in tasks:
+        task.cancel()
+
+
+def _is_up_to_date(filepath: pathlib.Path, size: int, mtime: float) -> bool:
+    """
+    Check if `filepath` exists and has the given size and modification time
+    """
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return False
+    return stat.st_size == size and stat.st_mtime == mtime
 
 
 def get_relative_path(element: Union["Material", "Videostore", "Assignment", "Folder", "File"]) -> str:
@@ -39,13 +81,13 @@ class Material:
     Material instances are obtained from
     politodown.get_material(year: int)
     """
+    __slots__ = ("year", "name", "_incarichi", "_assignments")
+
     def __init__(self, year: int, name: str, typ: str, mat: int):
         self.year = year
         self.name = name
-        self._incarichi = httpx.URL(
-            urls.did/"/pls/portal30/sviluppo.materiale.incarichi",
-            params={"mat": mat, "aa": year, "typ": typ},
-        )
+        self._incarichi = urls.incarichi.copy_with(
+            params={"mat": mat, "aa": year, "typ": typ})
         self._assignments = {}
 
     async def assignments(
@@ -62,11 +104,24 @@ class Material:
 
         self._assignments = {}
         response = await session.get(self._incarichi)
-        page = bs4.BeautifulSoup(response.content, "html.parser")
-        data_regex = re.compile(r"'(\d+)','(\d+)','(\d+)'")
-        for raw_assignment in page.find_all("a", {"class": "policorpo"}):
-            assignment_name = raw_assignment.text
-            inc, nod, doc = data_regex.search(raw_assignment["href"]).groups()
+        text = decode_page(response, response.content)
+        anchors = scan_anchors(text) if text is not None else None
+        if anchors is None:
+            page = bs4.BeautifulSoup(
+                response.content, "lxml", parse_only=_ASSIGNMENTS_STRAINER)
+            raw_assignments = [
+                (raw_assignment.text, raw_assignment["href"])
+                for raw_assignment in page.find_all("a", {"class": "policorpo"})
+            ]
+        else:
+            raw_assignments = [
+                (text, attributes["href"])
+                for attributes, text in anchors
+                if has_class(attributes, "policorpo")
+            ]
+
+        for assignment_name, href in raw_assignments:
+            inc, nod, doc = _ASSIGNMENT_DATA_RE.search(href).groups()
             assignment = Assignment(self, assignment_name, inc, nod, doc)
             self._assignments[assignment_name] = assignment
 
@@ -78,14 +133,13 @@ class Videostore:
     Material instances are obtained from
     politodown.get_videostores(year: int).
     """
+    __slots__ = ("year", "name", "category", "vis", "_videolessons")
+
     def __init__(self, year: int, category: str, name: str, cor: int):
         self.year = year
         self.name = name
         self.category = category
-        self.vis = httpx.URL(
-            urls.did/"pls/portal30/sviluppo.videolezioni.vis",
-            params={"cor": cor},
-        )
+        self.vis = urls.videolezioni.copy_with(params={"cor": cor})
         self._videolessons = {}
 
     async def videolessons(
@@ -100,44 +154,63 @@ class Videostore:
         if self._videolessons and not force_update:
             return self._videolessons
 
-        coros = await self._get_videolessons()
+        tasks = await self._get_videolessons()
+        try:
+            videolessons = await asyncio.gather(*tasks)
+        except BaseException:
+            # Don't leave the other requests running
+            _cancel(tasks)
+            raise
+
         self._videolessons = {
             videolesson.properties["name"]: videolesson
-            for videolesson in await asyncio.gather(*coros)
+            for videolesson in videolessons
         }
 
         return self._videolessons
 
-    async def _get_videolessons(self):
+    async def _get_videolessons(self) -> List["asyncio.Task[File]"]:
+        """
+        Parse the videostore page and create a task for each
+        videolesson fetching its infos. The tasks start once the
+        page has been parsed.
+        """
         response = await session.get(self.vis)
-        page = bs4.BeautifulSoup(response.content, "html.parser")
+        page = bs4.BeautifulSoup(
+            response.content, "lxml", parse_only=_VIDEOLESSONS_STRAINER)
 
         lessons = page.find_all("a", {"style": "color:#003576;"})
         dates = page.find_all("span", {"class": "small"})
         lessons_arguments = page.find_all("li", {"class": "argomentiEspansi"})
 
-        coros = []
+        tasks = []
+        try:
+            for lesson, date, arguments in zip(lessons, dates, lessons_arguments):
+                # Name
+                name = lesson.text
 
-        for lesson, date, arguments in zip(lessons, dates, lessons_arguments):
-            # Name
-            name = lesson.text
+                # Date
+                raw_date = date.text[4:]  # date = "del dd/mm/YYYY"
+                date = datetime.datetime.strptime(raw_date, "%d/%m/%Y")
 
-            # Date
-            raw_date = date.text[4:]  # date = "del dd/mm/YYYY"
-            date = datetime.datetime.strptime(raw_date, "%d/%m/%Y")
+                # Arguments
+                arguments = [
+                    argument.text
+                    for argument in arguments.find_all("a", {"class": "argoLink"})
+                ]
 
-            # Arguments
-            arguments = [
-                argument.text
-                for argument in arguments.find_all("a", {"class": "argoLink"})
-            ]
-
-            # Open the videolesson page to extract infos about the video file
-            url = urls.did/"pls/portal30/"/lesson['href']
+                # Open the videolesson page to extract infos about the video file
+                url = urls.portal/lesson['href']
 
-            coros.append(self._get_videolesson_info(url, name, date, arguments))
+                tasks.append(asyncio.create_task(
+                    self._get_videolesson_info(url, name, date, arguments)))
+        except BaseException:
+            # A row couldn't be parsed, the tasks already created
+            # would keep running with nobody awaiting them
+            _cancel(tasks)
+            raise
 
-        return coros
+        return tasks
 
     async def _get_videolesson_info(
         self,
@@ -147,43 +220,48 @@ class Videostore:
         arguments: List[str]
     ) -> "File":
         async with session.stream("GET", url) as stream:
-            page = bs4.BeautifulSoup(await stream.aread(), "html.parser")
+            content = await stream.aread()
+            page = bs4.BeautifulSoup(
+                content, "lxml", parse_only=_ANCHORS_STRAINER)
 
             videohref = urls.did/page.find("a", text="Video")["href"]
 
             # Videolesson's infos are stored in the `tmpTitle` variable in js
-            # This variable contains a multiline HTML string
-            raw_info_script = page.find("script", text=re.compile("tmpTitle"))
-            for i, line in enumerate(raw_info_script.string.split("\n")):
-                if "tmpTitle = " in line:
-                    # We found the beginning of the tmpTitle variable.
-                    # It's 7 lines long, we need to parse the HTML
-                    # string with bs4. Ugly but working.
-                    videoinfo = bs4.BeautifulSoup(
-                        "".join(x[23:-1] for x in raw_info_script.text.split("\n")[i:i+7]),
-                        "html.parser",
-                    )
-                    break
-            else:
-                # TODO: if this happens, the next step
-                #       will make the library crash
-                logging.error(url, "No videolesson info found")
-
+            # This variable contains a multiline HTML string, we need to
+            # parse it with lxml. Ugly but working.
+            raw_info = _TMPTITLE_RE.search(content)
+            if raw_info is None:
+                logging.error("%s: No videolesson info found", url)
+                raise VideolessonInfoNotFound(
+                    f"No videolesson info found: {url}")
+
+            # The charset may be declared only by the page,
+            # bs4 has already detected it then
+            encoding = (
+                stream.charset_encoding or page.original_encoding or "utf-8")
+            videoinfo = lxml.html.fragment_fromstring(
+                "".join(
+                    x[23:-1] for x in raw_info.group()
+                    .decode(encoding, errors="replace").split("\n")
+                ),
+                create_parent="div",
+            )
 
-            filename = videoinfo.find("td", text=" File").nextSibling.text
+            filename = videoinfo.xpath(
+                'string(.//td[normalize-space()="File"]/following-sibling::td[1])')
+            if not filename:
+                logging.error("%s: No videolesson filename found", url)
+                raise VideolessonInfoNotFound(
+                    f"No videolesson filename found: {url}")
 
             properties = {
                 "name": name,
                 "date": date,
                 "arguments": arguments,
-                **{
-                    name.text.strip().lower(): value.text
-                    for name, value in [
-                        info.find_all("td")
-                        for info in videoinfo.find_all("tr")
-                    ]
-                },
             }
+            for info in videoinfo.xpath(".//tr"):
+                key, value = (td.text_content() for td in info.findall("td")[:2])
+                properties[key.strip().lower()] = value
 
             return File(self, filename, videohref, properties=properties)
 
@@ -193,6 +271,8 @@ class Folder:
     Represents a folder.
     """
 
+    __slots__ = ("name", "parent", "_nextlevel", "_childs")
+
     def __init__(
         self,
         parent: Union["Folder", "Assignment", Videostore],
@@ -203,10 +283,8 @@ class Folder:
     ):
         self.name = name
         self.parent = parent
-        self._nextlevel = httpx.URL(
-            urls.did/"pls/portal30/sviluppo.materiale.next_level",
-            params={"inc": inc, "nod": nod, "doc": doc},
-        )
+        self._nextlevel = urls.next_level.copy_with(
+            params={"inc": inc, "nod": nod, "doc": doc})
         self._childs = None
 
     async def childs(
@@ -225,33 +303,24 @@ class Folder:
         response = await session.get(self._nextlevel)
         response.raise_for_status()
 
-        page = bs4.BeautifulSoup(response.content, "html.parser")
-
-        folder_regex = re.compile(r"'(\d+)','(\d+)','(\d+)'")
-        file_regex = re.compile(r"(\d+)$")
-
-        # File type could not be defined
-        info_regex = re.compile(r"(\w*) *\[([\w ]+)\]")
+        page = bs4.BeautifulSoup(response.content, "lxml")
 
         for raw_element in page.find_all("a"):
             name = raw_element.text
             href = raw_element["href"]
-            folder_match = folder_regex.search(href)
+            folder_match = _FOLDER_RE.search(href)
             if folder_match:  # Then it's a folder
                 inc, nod, doc = folder_match.groups()
                 element = Folder(self, name, inc, nod, doc)
             else:
-                file_match = file_regex.search(href)
+                file_match = _FILE_RE.search(href)
                 if not file_match:
                     continue
                 nod = file_match.group()
-                link = httpx.URL(
-                    urls.did/"pls/portal30/sviluppo.materiale.download",
-                    params={"nod": nod},
-                )
+                link = urls.download.copy_with(params={"nod": nod})
 
                 info = raw_element.nextSibling.nextSibling.nextSibling
-                extension, size = info_regex.search(info).groups()
+                extension, size = _INFO_RE.search(info).groups()
                 properties = {"extension": extension, "size": size}
 
                 element = File(self, name, link, properties=properties)
@@ -270,13 +339,37 @@ class Folder:
         yielded, but only after the files in the main folder.
         """
         childs = await self.childs(force_update)
+        async for file in self._files(childs, recursive, force_update):
+            yield file
+
+    async def _files(
+        self,
+        childs: Dict[str, Union["File", "Folder"]],
+        recursive: bool,
+        force_update: bool,
+    ) -> AsyncIterator["File"]:
+        """
+        Yield the files in `childs` and, if `recursive=True`, the
+        subfolders' ones, fetching each level's subfolders concurrently.
+        """
         for file in filter(lambda child: isinstance(child, File), childs.values()):
             yield file
 
         if recursive:
-            folders = filter(lambda child: isinstance(child, Folder), childs.values())
-            for folder in folders:
-                async for file in folder.files(True, force_update):
+            folders = [
+                child for child in childs.values() if isinstance(child, Folder)]
+            tasks = [
+                asyncio.create_task(folder.childs(force_update))
+                for folder in folders
+            ]
+            try:
+                folders_childs = await asyncio.gather(*tasks)
+            except BaseException:
+                # Don't leave the other requests running
+                _cancel(tasks)
+                raise
+            for folder, folder_childs in zip(folders, folders_childs):
+                async for file in folder._files(folder_childs, True, force_update):
                     yield file
 
 
@@ -286,15 +379,22 @@ class Assignment(Folder):
     been created only to discern assignments to folders.
     """
 
+    __slots__ = ()
+
 
 class File:
     """
     Represents a file
 
-    After the first time save() has been called, properties
-    `filename`, `size`, `date` and `etag` will be set.
+    After the first time head() or save() has been called,
+    properties `filename`, `size`, `date` and `etag` will be set.
     """
 
+    __slots__ = (
+        "parent", "name", "download", "properties",
+        "_filename", "_size", "_date", "_etag",
+    )
+
     def __init__(
         self,
         parent: Union[Folder, Assignment, Videostore],
@@ -371,49 +471,85 @@ class File:
         unless `overwrite` is `True`.
         """
         path = pathlib.Path(path)
+
+        # Check the file infos with a HEAD request first, so that
+        # we don't open a download at all if the file is up-to-date
+        await self.head()
+
+        filename = get_valid_filename(filename_generator(self))
+        if filename == "" or filename.isspace():
+            return
+
+        filepath = path/filename
+
+        mtime = time.mktime(self.date.timetuple())
+        if not overwrite and await asyncio.to_thread(
+                _is_up_to_date, filepath, self.size, mtime):
+            # Since a file already exists with the same size and the same
+            # creation time, and `overwrite` is `False`, do nothing.
+            yield -1
+            return
+
         async with session.stream("GET", self.download) as response:
-            if response.status_code == 403:
-                logging.error("%s: file not found", self.download)
-                raise FileNotFound("File not found")
-            response.raise_for_status()
-
-            self._filename, = re.match(
-                r'^.*filename="(.+)"$',
-                response.headers.get(
-                    "Content-Disposition",
-                    f'filename="{self.name}"',
-                ),
-            ).groups()
-            self._size = int(response.headers["Content-Length"])
-            self._date = datetime.datetime.strptime(
-                response.headers["Last-Modified"], "%a, %d %b %Y %H:%M:%S %Z")
-            self._etag = response.headers["ETag"]
-
-            filename = get_valid_filename(filename_generator(self))
-            if filename == "" or filename.isspace():
-                return
-
-            filepath = path/filename
-
-            mtime = time.mktime(self.date.timetuple())
-            if not overwrite and await aiofiles.os.path.exists(filepath) and \
-               await aiofiles.os.path.getsize(filepath) == self.size and \
-               await aiofiles.os.path.getmtime(filepath) == mtime:
-                # Since a file already exists with the same size and the same
-                # creation time, and `overwrite` is `False`, do nothing.
-                yield -1
-                return
+            self._raise_for_status(response)
 
             tmpfilepath = f"{filepath}.tmp"
 
-            async with aiofiles.open(tmpfilepath, "wb") as outfile:
-                async for chunk in response.aiter_bytes():
-                    yield await outfile.write(chunk)
+            outfile = await asyncio.to_thread(open, tmpfilepath, "wb")
+            try:
+                async for chunk in response.aiter_bytes(_CHUNK_SIZE):
+                    yield await asyncio.to_thread(outfile.write, chunk)
+            finally:
+                await asyncio.to_thread(outfile.close)
 
-            mtime = time.mktime(self.date.timetuple())
-            await aiofiles.os.rename(tmpfilepath, filepath)
+            await asyncio.to_thread(os.replace, tmpfilepath, filepath)
             os.utime(filepath, (mtime, mtime))
 
+    async def head(self) -> None:
+        """
+        Get file infos without downloading it.
+
+        Properties `filename`, `size`, `date` and `etag` will be set.
+        Many files can be checked concurrently with asyncio.gather().
+        """
+        response = await session.head(self.download)
+        self._raise_for_status(response)
+        if all(header in response.headers for header in _FILE_INFO_HEADERS):
+            self._read_info(response)
+            return
+
+        # The HEAD request didn't reach the file (e.g. the session
+        # expired and the SSO login needs a GET): open the download
+        # and read the infos without reading the body
+        async with session.stream("GET", self.download) as response:
+            self._raise_for_status(response)
+            self._read_info(response)
+
+    def _read_info(self, response: httpx.Response) -> None:
+        """
+        Set the file infos from the response headers
+        """
+        disposition = response.headers.get("Content-Disposition", "")
+        _, found, filename = disposition.rpartition('filename="')
+        if found and len(filename) > 1 and filename.endswith('"'):
+            self._filename = filename[:-1]
+        else:
+            self._filename = self.name
+        self._size = int(response.headers["Content-Length"])
+        self._date = datetime.datetime.strptime(
+            response.headers["Last-Modified"], "%a, %d %b %Y %H:%M:%S %Z")
+        self._etag = response.headers["ETag"]
+
+    def _raise_for_status(self, response: httpx.Response) -> None:
+        if response.status_code == 403:
+            logging.error("%s: file not found", self.download)
+            raise FileNotFound("File not found")
+        response.raise_for_status()
+
 
 class FileNotFound(Exception):
     pass
+
+
+class VideolessonInfoNotFound(Exception):
+    pass
@@ -1,14 +1,25 @@
-from typing import Optional
+from typing import Optional, Tuple
 import asyncio
 import logging
-import pickle
+import pathlib
+import json
+import atexit
+import random
+import threading
+import time
+import os
 
 import httpx
 import bs4
+import lxml  # noqa: F401  # fail loudly if the "lxml" parser is missing
 
 from . import urls
 
 
+_FORM_STRAINER = bs4.SoupStrainer("form")
+_LOGINERROR_STRAINER = bs4.SoupStrainer("span", {"id": "loginerror"})
+
+
 class AsyncClient(httpx.AsyncClient):
     """
     An async HTTP(S) client specialized for PoliTo servers.
@@ -16,9 +27,47 @@ class AsyncClient(httpx.AsyncClient):
     You must call login(...) after the creation of the instance.
     """
 
-    event = asyncio.Lock()
+    COOKIES_SAVE_INTERVAL = 5.0
+
+    # Throttled requests are retried with an exponential backoff
+    THROTTLING_BASE_DELAY = 0.5
+    THROTTLING_MAX_DELAY = 30.0
+    THROTTLING_MAX_RETRIES = 6
+
+    def __init__(self, *args, max_concurrency: int = 16, **kwargs):
+        # Bound the number of in-flight requests: gathering hundreds of
+        # videolessons at once makes the server throttle us (502).
+        # The semaphore is created by send(), in the running loop
+        self._max_concurrency = max_concurrency
+        self._sem = None
+        self._sem_loop = None
+
+        # Cookies are dumped at most once every `COOKIES_SAVE_INTERVAL`
+        # seconds, pending changes are flushed on close/exit
+        self._cookies_dirty = False
+        self._cookies_last_write = 0.0
+        # Dumps run in threads and share the temporary file: they're
+        # serialized, and a snapshot older than the last written is dropped
+        self._cookies_lock = threading.Lock()
+        self._cookies_snapshots = 0
+        self._cookies_written = 0
+        atexit.register(self._flush_cookies)
+
+        # Login requests and cookie file, set by signin()
+        self._cookie_path = None
+        self._login_url = None
+        self._chpass_url = None
+
+        # Keep connections alive and multiplex the requests over HTTP/2.
+        # These are passed to the client, not to a transport of ours:
+        # it builds its transports honouring verify, cert and proxies
+        kwargs.setdefault("http2", True)
+        kwargs.setdefault("limits", httpx.Limits(
+            max_connections=max_concurrency*2,
+            max_keepalive_connections=max_concurrency,
+            keepalive_expiry=90.0,
+        ))
 
-    def __init__(self, *args, **kwargs):
         event_hooks = kwargs.pop("event_hooks", {})
         _initkwargs = {
             "timeout": httpx.Timeout(10.0),
@@ -52,9 +101,22 @@ class AsyncClient(httpx.AsyncClient):
         super().__init__(*args, **{**kwargs, **_initkwargs})
 
     async def send(self, *args, **kwargs):
-        async with self.event:
+        # The client is built at import time, while on Python 3.9 a
+        # semaphore is bound to the loop current at its creation
+        loop = asyncio.get_running_loop()
+        if self._sem_loop is not loop:
+            self._sem = asyncio.Semaphore(self._max_concurrency)
+            self._sem_loop = loop
+        async with self._sem:
             return await super().send(*args, **kwargs)
 
+    async def aclose(self) -> None:
+        # Release the client, nothing is left to flush at exit
+        atexit.unregister(self._flush_cookies)
+        await super().aclose()
+        if self._cookies_dirty:
+            await asyncio.to_thread(self._dump_cookies, *self._serialize_cookies())
+
 
     async def signin(
         self,
@@ -70,16 +132,29 @@ class AsyncClient(httpx.AsyncClient):
         self._password = password
         self._cookie_path = cookie_path
 
+        # Credentials don't change until the next signin(),
+        # so the login requests are built only once
+        self._login_url = str(urls.login.copy_with(params={
+            "j_username": username,
+            "j_password": password,
+        }))
+        self._chpass_url = str(urls.login.copy_with(params={
+            "j_username": username,
+            "j_password": password,
+            "p_username": username,
+            "p_locale": "it",
+            "j_bypassScad": "S",
+        }))
+
         # Loads nothing if cookie_path hasn't been set
-        self._load_cookies()
+        await self._load_cookies()
 
         # Send the first request:
         # - If cookies are valid, nothing will happen.
         # - If cookies are invalid, expired or haven't been loaded, the custom
         #   HTTP client will login, and some more cookies we need to complete
         #   login from the main page, without reading the body
-        homepage = urls.did/"pls/portal30/sviluppo.pagina_studente_2016.main"
-        async with self.stream("GET", homepage):
+        async with self.stream("GET", urls.homepage):
             pass
 
     @property
@@ -96,7 +171,7 @@ class AsyncClient(httpx.AsyncClient):
             raise LoginError("You must login first.")
         return self._password
 
-    def _load_cookies(self) -> None:
+    async def _load_cookies(self) -> None:
         """
         Load cookies from the `cookies` file
         """
@@ -105,27 +180,34 @@ class AsyncClient(httpx.AsyncClient):
             return
 
         try:
-            with open(self._cookie_path, "rb") as f:
-                jar_cookies = pickle.load(f)
+            data = await asyncio.to_thread(
+                pathlib.Path(self._cookie_path).read_bytes)
         except FileNotFoundError:
             logging.warning("Cookie file not found")
             return
 
+        try:
+            jar_cookies = json.loads(data)
+        except ValueError:
+            # e.g. cookies pickled by older versions
+            logging.warning("Cookie file is not valid, ignoring it")
+            return
+
         # Load cookies into session
         for domain, pc in jar_cookies.items():
             for path, c in pc.items():
                 for k, v in c.items():
-                    self.cookies.set(k, v.value, domain=domain, path=path)
+                    self.cookies.set(k, v, domain=domain, path=path)
 
         self.cookies.jar.clear_expired_cookies()
 
 
     @staticmethod
-    def _redirect_to(response: httpx.Response, url: str):
+    def _redirect_to(response: httpx.Response, url: str, status_code: int = 302):
         """
         Convert the response to a redirect to the given url
         """
-        response.status_code = 302
+        response.status_code = status_code
         response.headers["Location"] = url
 
     async def _catch_forced_redirect(self, request):
@@ -141,25 +223,88 @@ class AsyncClient(httpx.AsyncClient):
     async def _handle_throttling(self, response):
         """
         Sometimes the server throttle us answering with 502 status
-        code because of too many requests, we'll retry in 5 seconds
+        code because of too many requests, we'll retry with an
+        exponential backoff, honouring the `Retry-After` header.
         """
         if response.status_code == 502:
-            # The server is throttling us because of
-            # too many requests, retry in 5 seconds
+            # The retries count is kept in the request extensions,
+            # which are copied to the redirect request
+            retries = response.request.extensions.get("throttling_retries", 0)
+            if retries >= self.THROTTLING_MAX_RETRIES:
+                logging.error("%s has been throttled too many times", response.url)
+                response.raise_for_status()
+
+            # The request holds its semaphore slot while sleeping
+            try:
+                delay = min(
+                    self.THROTTLING_MAX_DELAY,
+                    float(response.headers["Retry-After"]),
+                )
+            except (KeyError, ValueError):
+                delay = min(
+                    self.THROTTLING_MAX_DELAY,
+                    self.THROTTLING_BASE_DELAY * 2**retries,
+                ) + random.uniform(0, self.THROTTLING_BASE_DELAY)
+
             logging.info(
-                "%s has been throttled, retrying in 5 seconds...", response.url)
-            await asyncio.sleep(5)
-            self._redirect_to(response, response.url)
+                "%s has been throttled, retrying in %.1f seconds...",
+                response.url, delay,
+            )
+            response.request.extensions["throttling_retries"] = retries + 1
+            await asyncio.sleep(delay)
+            # A 307 repeats the request as is: a 302 would turn
+            # a POST (e.g. the login) into a GET without body
+            self._redirect_to(response, str(response.url), 307)
 
     async def _savecookies(self, _):
         """
-        Dump cookies in a file
+        Dump cookies in a file, at most once every `COOKIES_SAVE_INTERVAL`
+        seconds. Pending changes are written by aclose() or at exit.
         """
-        # TODO: saving cookies on a file each time we make a
-        #       request could cause some performance issues
-        if self._cookie_path is not None:
-            with open(self._cookie_path, "wb") as cookies:
-                pickle.dump(self.cookies.jar._cookies, cookies)
+        if self._cookie_path is None:
+            return
+
+        self._cookies_dirty = True
+        now = time.monotonic()
+        if now - self._cookies_last_write > self.COOKIES_SAVE_INTERVAL:
+            self._cookies_last_write = now
+            # Serialize here: the jar could change while the thread runs
+            await asyncio.to_thread(self._dump_cookies, *self._serialize_cookies())
+
+    def _serialize_cookies(self) -> Tuple[int, bytes]:
+        """
+        Snapshot the cookies, return the snapshot number and the data
+        """
+        self._cookies_dirty = False
+        self._cookies_snapshots += 1
+        # {domain: {path: {name: value}}}
+        return self._cookies_snapshots, json.dumps({
+            domain: {
+                path: {name: cookie.value for name, cookie in c.items()}
+                for path, c in pc.items()
+            }
+            for domain, pc in self.cookies.jar._cookies.items()
+        }).encode()
+
+    def _dump_cookies(self, snapshot: int, data: bytes) -> None:
+        """
+        Atomically replace the cookie file with `data`
+        """
+        tmp_path = f"{self._cookie_path}.tmp"
+        with self._cookies_lock:
+            if snapshot < self._cookies_written:
+                return
+            self._cookies_written = snapshot
+            with open(tmp_path, "wb") as cookies:
+                cookies.write(data)
+            os.replace(tmp_path, self._cookie_path)
+
+    def _flush_cookies(self) -> None:
+        """
+        Synchronously write pending cookies, used at interpreter exit
+        """
+        if self._cookies_dirty:
+            self._dump_cookies(*self._serialize_cookies())
 
     @staticmethod
     def _get_to_post_redirect(request):
@@ -184,12 +329,9 @@ class AsyncClient(httpx.AsyncClient):
         """
         # Server is asking us to login again
         if response.url == urls.loginpage:
-            params = {
-                "j_username": self.username,
-                "j_password": self.password,
-            }
-            url = httpx.URL(urls.login, params=params)
-            self._redirect_to(response, str(url))
+            if self._login_url is None:
+                raise LoginError("You must login first.")
+            self._redirect_to(response, self._login_url)
 
     async def _handle_exipiring_password(self, response):
         """
@@ -197,26 +339,24 @@ class AsyncClient(httpx.AsyncClient):
         """
         if response.url.path == "/Chpass/chpassservlet/main.htm":
             logging.info("Password is expiring soon")
-            params = {
-                "j_username": self.username,
-                "j_password": self.password,
-                "p_username": self.username,
-                "p_locale": "it",
-                "j_bypassScad": "S",
-            }
-            url = httpx.URL(urls.login, params=params)
-            self._redirect_to(response, str(url))
+            if self._chpass_url is None:
+                raise LoginError("You must login first.")
+            self._redirect_to(response, self._chpass_url)
 
     async def _handle_sso_request(self, response):
         """
         Handle Single Server Auth request that the PoliTo servers love so much
+
+        HEAD responses have no form to submit: they're left as they are,
+        the caller has to repeat the request with a GET.
         """
-        if response.is_success:
+        if response.is_success and response.request.method != "HEAD":
             if response.url.path == "/idp/profile/SAML2/Redirect/SSO":
                 logging.info("SSO AUTH REQUEST")
                 # Extract SSO params
                 content = await response.aread()
-                page = bs4.BeautifulSoup(content, "html.parser")
+                page = bs4.BeautifulSoup(
+                    content, "lxml", parse_only=_FORM_STRAINER)
 
                 form = page.find("form")
                 params = {
@@ -237,7 +377,10 @@ class AsyncClient(httpx.AsyncClient):
         If it's not, clean credentials.
         """
         if not response.is_redirect and response.url == urls.login:
-            page = bs4.BeautifulSoup(await response.aread(), "html.parser")
+            page = bs4.BeautifulSoup(
+                await response.aread(), "lxml",
+                parse_only=_LOGINERROR_STRAINER,
+            )
             error = page.find("span", {"id": "loginerror"}).text
             logging.error(error)
             raise LoginError(error)
@@ -0,0 +1,161 @@
+from typing import Optional, Dict, List, Tuple
+import codecs
+import html
+import re
+
+import httpx
+import bs4
+
+
+# Anchors without nested tags, and their attributes.
+# Quoted attribute values may contain a `>`
+_ANCHOR_RE = re.compile(
+    r"""<a\s((?:[^>"']|"[^"]*"|'[^']*')*)>([^<]*)</a>""", re.I)
+_ANCHOR_START_RE = re.compile(r"<a\s", re.I)
+_ATTRIBUTE_RE = re.compile(r"""([\w-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+# Anchors in comments, scripts and in elements holding only
+# text aren't part of the page. `<!-->` is an empty comment
+_SKIPPED_RE = re.compile(
+    r"<!---?>|<!--.*?-->|<(script|style|title|textarea)\b.*?</\1\s*>",
+    re.I | re.S,
+)
+_SKIPPED_START_RE = re.compile(
+    r"<!--|<(?:script|style|title|textarea)\b", re.I)
+# Parsers normalize newlines
+_NEWLINE_RE = re.compile(r"\r\n?")
+
+
+def get_class_pattern(class_: str) -> re.Pattern:
+    """
+    Match `class_` in a class attribute. Unlike find_all(), a SoupStrainer
+    may see the whole attribute (e.g. "policorpo x") while parsing.
+    """
+    return re.compile(rf"(?:^|\s){re.escape(class_)}(?:\s|$)")
+
+
+def _unescape(text: str) -> str:
+    return html.unescape(_NEWLINE_RE.sub("\n", text))
+
+
+class AnchorScanner:
+    """
+    Extract the anchors of a page as (attributes, text) pairs, in
+    document order, using regexes: it's way faster than building
+    the whole tree with bs4 on the simple listing pages.
+
+    The page can be fed in chunks while it's downloaded.
+    """
+
+    def __init__(self):
+        self._anchors = []
+        self._anchor_starts = 0
+        # Set if an anchor has attributes that can't be scanned
+        self._failed = False
+        # Text that could still contain (the beginning of) an anchor
+        self._buffer = ""
+
+    def feed(self, text: str) -> None:
+        """
+        Scan the anchors completed by `text`.
+        """
+        buffer = _SKIPPED_RE.sub("", self._buffer + text)
+        # An unterminated comment or script is kept until its end is fed
+        skipped = _SKIPPED_START_RE.search(buffer)
+        limit = skipped.start() if skipped else len(buffer)
+
+        end = 0
+        for match in _ANCHOR_RE.finditer(buffer, 0, limit):
+            attributes = {}
+            for attribute in _ATTRIBUTE_RE.finditer(match[1]):
+                name, *values = attribute.groups()
+                value = next(value for value in values if value is not None)
+                # The first of duplicated attributes wins
+                attributes.setdefault(name.lower(), _unescape(value))
+            if _ATTRIBUTE_RE.sub("", match[1]).strip():
+                self._failed = True
+            self._anchors.append((attributes, _unescape(match[2])))
+            end = match.end()
+
+        # Keep only what follows the last anchor start, or the last
+        # characters that could be the beginning of one (or of a comment)
+        starts = [
+            match.start()
+            for match in _ANCHOR_START_RE.finditer(buffer, end, limit)
+        ]
+        keep = starts[-1] if starts else max(end, limit - len("<textarea"))
+        self._anchor_starts += len(_ANCHOR_START_RE.findall(buffer, 0, keep))
+        self._buffer = buffer[keep:]
+
+    def close(self) -> Optional[List[Tuple[Dict[str, str], str]]]:
+        """
+        Return the scanned anchors, or None if some anchors can't be
+        extracted this way (e.g. they contain other tags): the page
+        must be parsed then.
+        """
+        buffer = _SKIPPED_RE.sub("", self._buffer)
+        anchor_starts = self._anchor_starts + len(
+            _ANCHOR_START_RE.findall(buffer))
+        if self._failed or len(self._anchors) != anchor_starts:
+            return None
+        return self._anchors
+
+
+def scan_anchors(page: str) -> Optional[List[Tuple[Dict[str, str], str]]]:
+    """
+    Scan the anchors of a whole page, see AnchorScanner.
+    """
+    scanner = AnchorScanner()
+    scanner.feed(page)
+    return scanner.close()
+
+
+def has_class(attributes: Dict[str, str], class_: str) -> bool:
+    """
+    Check if the attributes returned by scan_anchors() contain `class_`
+    """
+    return class_ in attributes.get("class", "").split()
+
+
+def get_declared_encoding(
+    response: httpx.Response, content: bytes
+) -> Optional[str]:
+    """
+    Get the charset declared by the response headers or by the
+    <meta> tags of `content`, None if there's none.
+    """
+    return (
+        response.charset_encoding
+        or bs4.dammit.EncodingDetector.find_declared_encoding(
+            content, is_html=True)
+    )
+
+
+def get_decoder(
+    response: httpx.Response, content: bytes
+) -> Optional[codecs.IncrementalDecoder]:
+    """
+    Get a strict decoder for the charset declared by the response
+    headers or by `content`, None if there's none (or it's unknown).
+    """
+    encoding = get_declared_encoding(response, content)
+    if encoding is None:
+        return None
+    try:
+        return codecs.getincrementaldecoder(encoding)()
+    except LookupError:
+        return None
+
+
+def decode_page(response: httpx.Response, content: bytes) -> Optional[str]:
+    """
+    Decode `content` with its declared charset. Return None if it can't
+    be decoded this way: the page must be parsed by bs4 then, which
+    guesses the charset.
+    """
+    encoding = get_declared_encoding(response, content)
+    if encoding is None:
+        return None
+    try:
+        return content.decode(encoding)
+    except (LookupError, UnicodeDecodeError):
+        return None
@@ -1,79 +1,178 @@
+from typing import Optional, List, Tuple, Dict
 import logging
 import re
 
-import httpx
+import soupsieve
 import bs4
+import lxml  # noqa: F401  # fail loudly if the "lxml" parser is missing
 
 from .datatypes import Material, Videostore
+from .parsing import AnchorScanner, has_class, get_class_pattern, get_decoder
 from . import session, urls
 
-async def get_material(year: int) -> dict[str, Material]:
+
+_MAT_RE = re.compile(r"'(\d+)','(\w+)','\d+','(\d+)'")
+_VIS_RE = re.compile(r"sviluppo\.videolezioni\.vis\?cor=(\d+)")
+
+_MATERIAL_STRAINER = bs4.SoupStrainer(
+    "a", class_=get_class_pattern("policorpolink"))
+# A strainer can't match both the videostores links and the `policorpo`
+# divs with their videolessons: the page is parsed once for each, two
+# small trees are still cheaper to build than the whole page
+_VIDEOSTORE_STRAINER = bs4.SoupStrainer(
+    "a", onclick=lambda value: value is not None and "showDivVideoteca(" in value)
+_POLICORPO_STRAINER = bs4.SoupStrainer(
+    "div", class_=get_class_pattern("policorpo"))
+
+_POLICORPOLINK_SELECT = soupsieve.compile("a.policorpolink")
+
+# Responses cached by year
+_material = {}
+_videostores = {}
+
+
+async def get_material(
+    year: int, force_update: bool = False
+) -> dict[str, Material]:
     """
-    Get the material available for a given year.
+    Get the material available for a given year and cache the response.
+
+    Cache will be overwrite only if `force_update` is `True`
     """
-    response = await session.get(
-        httpx.URL(
-            urls.did/"pls/portal30/sviluppo.materiale.elenco",
-            params={"a": year, "t": "M"},
-        ),
-    )
-
-    response.raise_for_status()
-    if response.content == b'Access denied!\n':
-        logging.error(response.url, "ACCESS DENIED")
-    assert response.content != b'Access denied!\n'
-
-    page = bs4.BeautifulSoup(response.content, "html.parser")
-    material = {}
+    if year in _material and not force_update:
+        return _material[year]
+
+    content, anchors = await _get_listing(year, "M")
+    if anchors is None:
+        page = bs4.BeautifulSoup(
+            content, "lxml", parse_only=_MATERIAL_STRAINER)
+        raw_subjects = [
+            (raw_subject.text, raw_subject["href"])
+            for raw_subject in page.find_all("a", {"class": "policorpolink"})
+        ]
+    else:
+        raw_subjects = [
+            (text, attributes["href"])
+            for attributes, text in anchors
+            if has_class(attributes, "policorpolink")
+        ]
 
-    data_regex = re.compile(r"'(\d+)','(\w+)','\d+','(\d+)'")
-    for raw_subject in page.find_all("a", {"class": "policorpolink"}):
-        material_name = raw_subject.text
-        aa, typ, mat = data_regex.search(raw_subject["href"]).groups()
+    material = {}
+    for material_name, href in raw_subjects:
+        aa, typ, mat = _MAT_RE.search(href).groups()
         material[material_name] = Material(aa, material_name, typ, mat)
 
+    _material[year] = material
     return material
 
-async def get_videostores(year: int) -> dict[str, Videostore]:
+async def get_videostores(
+    year: int, force_update: bool = False
+) -> dict[str, Videostore]:
     """
-    Get the videostores available for a given year.
+    Get the videostores available for a given year and cache the response.
+
+    Cache will be overwrite only if `force_update` is `True`
     """
-    response = await session.get(
-        httpx.URL(
-            urls.did/"pls/portal30/sviluppo.materiale.elenco",
-            params={"a": year, "t": "E"},
-        ),
-    )
-
-    response.raise_for_status()
-    if response.content == b'Access denied!\n':
-        logging.error(response.url, "ACCESS DENIED")
-    assert response.content != b'Access denied!\n'
-
-    page = bs4.BeautifulSoup(response.content, "html.parser")
-    videostores = {}
+    if year in _videostores and not force_update:
+        return _videostores[year]
 
-    data_regex = re.compile(r"sviluppo\.videolezioni\.vis\?cor=(\d+)")
-    raw_videostores = page.find_all("a", {"onclick": re.compile(r"showDivVideoteca\('\w+'\)")})
-    videolessons_group = page.find_all("div", {"class": "policorpo"})
-    for videostore, raw_videolessons in zip(raw_videostores, videolessons_group):
+    content, _ = await _get_listing(year, "E", scan=False)
+    raw_videostores = _parse_videostores(content)
 
-        videostore_name = videostore.text.strip()
-        videolessons = {}
+    videostores = {}
+    for videostore_name, raw_videolessons in raw_videostores:
+        videolesson_items = []
 
-        for videolesson in raw_videolessons.find_all("a", {"class": "policorpolink"}):
-            if not data_regex.match(videolesson["href"]):
+        for videolesson_name, href in raw_videolessons:
+            vis_match = _VIS_RE.match(href)
+            if not vis_match:
                 logging.info(
                     "Skipping %s - %s because it's not supported yet.",
-                    videostore.text, videolesson.text
+                    videostore_name, videolesson_name
                 )
                 continue
 
-            videolesson_name = videolesson.text.strip()
-            cor, = data_regex.search(videolesson["href"]).groups()
-            videolessons[videolesson_name] = \
-                Videostore(year, videostore_name, videolesson_name, cor)
+            cor, = vis_match.groups()
+            videolesson_items.append((
+                videolesson_name,
+                Videostore(year, videostore_name, videolesson_name, cor),
+            ))
 
-        videostores[videostore_name] = videolessons
+        videostores[videostore_name] = dict(videolesson_items)
 
+    _videostores[year] = videostores
     return videostores
+
+
+async def _get_listing(
+    year: int, typ: str, scan: bool = True
+) -> Tuple[bytes, Optional[List[Tuple[Dict[str, str], str]]]]:
+    """
+    Download the listing of type `typ` for the given year, scanning
+    its anchors while it's downloaded if `scan` is `True`.
+
+    Return the page and its anchors (None if they can't
+    be scanned, see AnchorScanner).
+
+    Raise PermissionError if the server denies the access.
+    """
+    url = urls.elenco.copy_with(params={"a": year, "t": typ})
+    content = bytearray()
+    scanner = AnchorScanner() if scan else None
+    decoder = None
+    async with session.stream("GET", url) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            content += chunk
+            if scanner is None:
+                continue
+            if decoder is None:
+                # The charset is declared by the headers or at the
+                # beginning of the page, otherwise bs4 will guess it
+                decoder = get_decoder(response, chunk)
+                if decoder is None:
+                    scanner = None
+                    continue
+            try:
+                scanner.feed(decoder.decode(chunk))
+            except UnicodeDecodeError:
+                scanner = None
+        if scanner is not None and decoder is not None:
+            try:
+                scanner.feed(decoder.decode(b"", final=True))
+            except UnicodeDecodeError:
+                scanner = None
+
+    if content.startswith(b'Access denied!'):
+        logging.error("%s: ACCESS DENIED", response.url)
+        raise PermissionError(f"Access denied: {response.url}")
+
+    return bytes(content), scanner and scanner.close()
+
+
+def _parse_videostores(
+    content: bytes
+) -> List[Tuple[str, List[Tuple[str, str]]]]:
+    """
+    Extract (videostore name, [(videolesson name, href), ...]) pairs
+    from the videostores page.
+
+    The videolessons of each videostore are in the `policorpo` div that
+    follows its link: anchor order alone can't tell where they belong.
+    """
+    raw_videostores = bs4.BeautifulSoup(
+        content, "lxml", parse_only=_VIDEOSTORE_STRAINER).find_all("a")
+    videolessons_group = bs4.BeautifulSoup(
+        content, "lxml", parse_only=_POLICORPO_STRAINER,
+    ).find_all("div", class_="policorpo")
+
+    return [
+        (
+            videostore.text.strip(),
+            [
+                (videolesson.text.strip(), videolesson["href"])
+                for videolesson in _POLICORPOLINK_SELECT.select(raw_videolessons)
+            ],
+        )
+        for videostore, raw_videolessons in zip(raw_videostores, videolessons_group)
+    ]
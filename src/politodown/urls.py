@@ -1,13 +1,20 @@
+import functools
+
 import httpx
 
 
+@functools.lru_cache(maxsize=256)
+def _join(base: str, url: str) -> httpx.URL:
+    return httpx.URL(base).join(url)
+
+
 class BaseURL(httpx.URL):
     """
     A pathlib-like version of httpx.URL
     """
 
     def __truediv__(self, url):
-        return BaseURL(self.join(url))
+        return BaseURL(_join(str(self), url))
 
 
 IDP = BaseURL("https://idp.polito.it/")
@@ -15,3 +22,11 @@ did = BaseURL("https://didattica.polito.it/")
 
 loginpage = IDP/"idp/x509mixed-login"
 login = IDP/"idp/Authn/X509Mixed/UserPasswordLogin"
+
+portal = did/"pls/portal30/"
+homepage = portal/"sviluppo.pagina_studente_2016.main"
+elenco = portal/"sviluppo.materiale.elenco"
+incarichi = portal/"sviluppo.materiale.incarichi"
+next_level = portal/"sviluppo.materiale.next_level"
+download = portal/"sviluppo.materiale.download"
+videolezioni = portal/"sviluppo.videolezioni.vis"
@@ -0,0 +1,29 @@
+import asyncio
+
+import httpx
+import pytest
+
+from politodown.http import AsyncClient
+
+
+def test_throttling_retries():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(502, headers={"Retry-After": "3600"})
+
+    async def main():
+        client = AsyncClient(transport=httpx.MockTransport(handler))
+        client.THROTTLING_MAX_DELAY = 0.0
+        try:
+            with pytest.raises(httpx.HTTPStatusError):
+                await client.post("https://example.com/login", data={"a": "b"})
+        finally:
+            await client.aclose()
+
+    asyncio.run(main())
+    assert len(requests) == 1 + AsyncClient.THROTTLING_MAX_RETRIES
+    # The request is repeated as is
+    assert all(request.method == "POST" for request in requests)
+    assert all(request.content == b"a=b" for request in requests)
@@ -0,0 +1,83 @@
+import bs4
+import pytest
+
+from politodown.parsing import AnchorScanner, scan_anchors
+
+
+LISTING = """<html>
+<head><meta charset="utf-8"><title>Materiale</title>
+<script>document.write('<a class="policorpolink" href="#">Script</a>');</script>
+</head>
+<body>
+<!-- <a class="policorpolink" href="#">Commented</a> -->
+<ul>
+  <li><a class="policorpolink" href="javascript:apri('2020','M','1','123')">Analisi I</a></li>
+  <li><A CLASS="policorpolink x" HREF='javascript:apri(&#39;2020&#39;,&#39;M&#39;,&#39;1&#39;,&#39;456&#39;)'>Fisica &amp; Chimica</A></li>
+  <li><a class=policorpolink href=javascript:void(0) title="a > b">Geometria</a></li>
+  <li><a onclick="if(a>b)x()" class="policorpolink" href="h">Informatica</a></li>
+  <li><a href="/other">Home&nbsp;page</a></li>
+</ul>
+</body></html>
+"""
+
+
+def parse_anchors(page: str):
+    """
+    The anchors found by bs4, in the scanner format
+    """
+    page = bs4.BeautifulSoup(page, "lxml", parse_only=bs4.SoupStrainer("a"))
+    return [
+        (
+            {
+                name: " ".join(value) if isinstance(value, list) else value
+                for name, value in anchor.attrs.items()
+            },
+            anchor.text,
+        )
+        for anchor in page.find_all("a")
+    ]
+
+
+def test_listing_matches_bs4():
+    anchors = scan_anchors(LISTING)
+    assert anchors is not None
+    assert anchors == parse_anchors(LISTING)
+
+
+@pytest.mark.parametrize("page", [
+    # Newlines are normalized
+    '<a href="x" title="a\r\nb\rc">A\r\nB\rC</a>',
+    # The first of duplicated attributes wins
+    '<a href="1" HREF="2">x</a>',
+    # Elements holding only text
+    '<title><a href="x">t</a></title>'
+    '<textarea><a href="y">u</a></textarea><a href="z">v</a>',
+    # Empty comments
+    '<!--> <a href="x">A</a> --> <!---> <a href="y">B</a> -->',
+])
+def test_edge_cases_match_bs4(page):
+    anchors = scan_anchors(page)
+    assert anchors is not None
+    assert anchors == parse_anchors(page)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, 64])
+def test_chunks_match_whole_page(size):
+    scanner = AnchorScanner()
+    for i in range(0, len(LISTING), size):
+        scanner.feed(LISTING[i:i+size])
+    assert scanner.close() == scan_anchors(LISTING)
+
+
+@pytest.mark.parametrize("page", [
+    # Nested tags
+    '<a href="h"><b>Name</b></a>',
+    # Attributes that can't be scanned
+    '<a download href="h">Name</a>',
+    # Anchor never closed
+    '<a href="h">Name',
+    # Comment never closed
+    '<a href="h">Name</a><!-- <a href="x">X</a>',
+])
+def test_fallback(page):
+    assert scan_anchors(page) is None